@@ -13,12 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import asyncio
 import atexit
-import base64
+import concurrent.futures
 import logging
 import os
 import re
+import shlex
 import subprocess
+import threading
+import time
+import uuid
+import weakref
 
 
 class FindDeviceError(RuntimeError):
@@ -47,24 +53,108 @@ class ShellError(RuntimeError):
         self.exit_code = exit_code
 
 
-def get_devices(adb_path='adb'):
-    with open(os.devnull, 'wb') as devnull:
-        subprocess.check_call([adb_path, 'start-server'], stdout=devnull,
-                              stderr=devnull)
-    out = subprocess.check_output([adb_path, 'devices']).splitlines()
+# How much to read from an adb pipe at a time. This matches the default pipe
+# capacity on Linux, so a full pipe is drained in a single read.
+_PIPE_READ_SIZE = 64 * 1024
+
+# Longest script we send over a persistent shell session. Older adbd attaches
+# the session to a pty, whose line discipline truncates input lines at 4096
+# bytes; longer commands use a one-off `adb shell` instead.
+_PERSISTENT_SHELL_MAX_SCRIPT = 4000
+
+# Matches a `getprop` line, capturing the property name and value.
+_GETPROP_RE = re.compile(br'^\[([^]]+)\]: \[(.*)\]')
+
+# How long, in seconds, an `adb devices` listing is reused before we ask the
+# adb server again. The device list rarely changes, and resolving several
+# devices in a row shouldn't pay for a fresh enumeration each time.
+_DEVICES_CACHE_TTL = 2.0
+
+# Maps adb_path to a (timestamp, [serials]) tuple.
+_DEVICES_CACHE = {}
+
+# adb_paths for which `adb start-server` has already been run.
+_STARTED_SERVERS = set()
+
+# Maps an AndroidDevice's adb command prefix (adb path, serial and product)
+# to a (features, needs_probe) tuple: the result of `adb features`, and
+# whether shell output needs the exit code probe because shell_v2 is missing.
+_FEATURES_CACHE = {}
+
+# Maps an AndroidDevice's adb command prefix to the line separator its shell
+# output uses.
+_LINESEP_CACHE = {}
 
-    # The first line of `adb devices` just says "List of attached devices", so
-    # skip that.
+
+def _start_server(adb_path):
+    if adb_path in _STARTED_SERVERS:
+        return
+    subprocess.check_call([adb_path, 'start-server'],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _STARTED_SERVERS.add(adb_path)
+
+
+def _invalidate_devices_cache(adb_path):
+    _DEVICES_CACHE.pop(adb_path, None)
+
+
+def _clear_device_info_for_host(host):
+    """Drops cached device info for the device `adb connect host` names."""
+    # adb fills in the default port when `host` doesn't have one.
+    serial = host if ':' in host else host + ':5555'
+    for cache in (_FEATURES_CACHE, _LINESEP_CACHE):
+        for key in list(cache):
+            if '-s' in key and key[key.index('-s') + 1] == serial:
+                del cache[key]
+
+
+def get_devices(adb_path='adb'):
+    cached = _DEVICES_CACHE.get(adb_path)
+    if cached is not None:
+        timestamp, devices = cached
+        if time.monotonic() - timestamp < _DEVICES_CACHE_TTL:
+            return list(devices)
+
+    # `adb devices` starts the server itself if it isn't running, so there's
+    # no need to fork a separate `adb start-server` first.
+    result = subprocess.run([adb_path, 'devices'], stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, check=True)
+    _STARTED_SERVERS.add(adb_path)
+
+    # The listing starts with a "List of devices attached" header, which may
+    # itself be preceded by "* daemon ... *" lines if `adb devices` had to
+    # start the server. Skip all of those. Device lines are "<serial>\t<state>".
     devices = []
-    for line in out[1:]:
-        if not line.strip():
+    for line in result.stdout.splitlines():
+        if line.startswith(b'*') or line.startswith(b'List of devices'):
             continue
-        if 'offline' in line:
+        # Anything without a tab (e.g. "adb server is out of date" from an
+        # older server being restarted) isn't a device line.
+        serial, separator, state = line.partition(b'\t')
+        if not separator or not serial or b'offline' in state:
             continue
+        devices.append(serial.decode('utf-8'))
+    _DEVICES_CACHE[adb_path] = (time.monotonic(), devices)
+    return list(devices)
 
-        serial, _ = re.split(r'\s+', line, maxsplit=1)
-        devices.append(serial)
-    return devices
+
+def map_devices(fn, devices, max_workers=8):
+    """Calls `fn` on each of `devices` concurrently.
+
+    Each adb call is its own subprocess, so running them from a thread pool
+    overlaps the per-device round trips rather than serializing them.
+
+    Args:
+        fn: Function taking a single element of `devices`.
+        devices: Iterable of devices (e.g. serials from get_devices(), or
+            AndroidDevice objects).
+        max_workers: Maximum number of devices to operate on at once.
+
+    Returns:
+        A list of the results of `fn`, in the same order as `devices`.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(fn, devices))
 
 
 def _get_unique_device(product=None, adb_path='adb'):
@@ -113,16 +203,14 @@ def get_device(serial=None, product=None, adb_path='adb'):
 
 
 def _get_device_by_type(flag, adb_path):
-    with open(os.devnull, 'wb') as devnull:
-        subprocess.check_call([adb_path, 'start-server'], stdout=devnull,
-                              stderr=devnull)
+    _start_server(adb_path)
     try:
         serial = subprocess.check_output([adb_path, flag, 'get-serialno']).strip()
     except subprocess.CalledProcessError:
         raise RuntimeError('adb unexpectedly returned nonzero')
-    if serial == 'unknown':
+    if serial == b'unknown':
         raise NoUniqueDeviceError()
-    return _get_device_by_serial(serial, adb_path=adb_path)
+    return _get_device_by_serial(serial.decode('utf-8'), adb_path=adb_path)
 
 
 def get_usb_device(adb_path='adb'):
@@ -151,59 +239,31 @@ def get_emulator_device(adb_path='adb'):
     return _get_device_by_type('-e', adb_path=adb_path)
 
 
-# If necessary, modifies subprocess.check_output() or subprocess.Popen() args to run the subprocess
-# via Windows PowerShell to work-around an issue in Python 2's subprocess class on Windows where it
-# doesn't support Unicode.
-def _get_subprocess_args(args):
-    # Only do this slow work-around if Unicode is in the cmd line on Windows. PowerShell takes
-    # 600-700ms to startup on a 2013-2014 machine, which is very slow.
-    if (os.name != 'nt' or all(not isinstance(arg, unicode) for arg in args[0])):
-        return args
-
-    def escape_arg(arg):
-        # Escape for the parsing that the C Runtime does in Windows apps. In particular, this will
-        # take care of double-quotes.
-        arg = subprocess.list2cmdline([arg])
-        # Escape single-quote with another single-quote because we're about to...
-        arg = arg.replace(u"'", u"''")
-        # ...put the arg in a single-quoted string for PowerShell to parse.
-        arg = u"'" + arg + u"'"
-        return arg
-
-    # Escape command line args.
-    argv = map(escape_arg, args[0])
-    # Cause script errors (such as adb not found) to stop script immediately with an error.
-    ps_code = u'$ErrorActionPreference = "Stop"\r\n';
-    # Add current directory to the PATH var, to match cmd.exe/CreateProcess() behavior.
-    ps_code += u'$env:Path = ".;" + $env:Path\r\n';
-    # Precede by &, the PowerShell call operator, and separate args by space.
-    ps_code += u'& ' + u' '.join(argv)
-    # Make the PowerShell exit code the exit code of the subprocess.
-    ps_code += u'\r\nExit $LastExitCode'
-    # Encode as UTF-16LE (without Byte-Order-Mark) which Windows natively understands.
-    ps_code = ps_code.encode('utf-16le')
-
-    # Encode the PowerShell command as base64 and use the special -EncodedCommand option that base64
-    # decodes. Base64 is just plain ASCII, so it should have no problem passing through Win32
-    # CreateProcessA() (which python erroneously calls instead of CreateProcessW()).
-    return (['powershell.exe', '-NoProfile', '-NonInteractive', '-EncodedCommand',
-             base64.b64encode(ps_code)],) + args[1:]
-
-
-# Call this instead of subprocess.check_output() to work-around issue in Python
-# 2's subprocess class on Windows where it doesn't support Unicode.
-def _subprocess_check_output(*args, **kwargs):
-    try:
-        return subprocess.check_output(*_get_subprocess_args(args), **kwargs)
-    except subprocess.CalledProcessError as e:
-        # Show real command line instead of the powershell.exe command line.
-        raise subprocess.CalledProcessError(e.returncode, args[0],
-                                            output=e.output)
+def _kill_process(p):
+    p.kill()
+    p.communicate()
+
 
+def _log_command(*parts):
+    """Logs the command made up of |parts| (lists of arguments) at INFO.
+
+    The command string is only built if INFO logging is enabled, since this
+    runs for every adb call.
+    """
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info('%s', ' '.join(arg for part in parts for arg in part))
 
-# Call this instead of subprocess.Popen(). Like _subprocess_check_output().
-def _subprocess_Popen(*args, **kwargs):
-    return subprocess.Popen(*_get_subprocess_args(args), **kwargs)
+
+def _iter_lines(chunks):
+    """Splits an iterable of bytes chunks into lines, without line endings."""
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip(b'\r')
+    if pending:
+        yield pending.rstrip(b'\r')
 
 
 class AndroidDevice(object):
@@ -233,41 +293,77 @@ class AndroidDevice(object):
             self.adb_cmd.extend(['-s', serial])
         if self.product is not None:
             self.adb_cmd.extend(['-p', product])
-        self._linesep = None
-        self._features = None
+        self._adb_shell_cmd = tuple(self.adb_cmd + ['shell'])
+        self._cache_key = tuple(self.adb_cmd)
+        if self.serial is None:
+            # Without a serial adb picks whichever device is available, so
+            # what we learn about it can't be shared with other instances.
+            self._features_cache = {}
+            self._linesep_cache = {}
+        else:
+            self._features_cache = _FEATURES_CACHE
+            self._linesep_cache = _LINESEP_CACHE
+        # Set to the fallback ([], True) once `adb features` has failed, so we
+        # don't retry it on every shell call; cleared with the cached info.
+        self._failed_feature_info = None
+        self._persistent_shell = None
+        self._persistent_shell_finalizer = None
+        self._persistent_shell_lock = threading.Lock()
 
     @property
     def linesep(self):
-        if self._linesep is None:
-            self._linesep = subprocess.check_output(self.adb_cmd +
-                                                    ['shell', 'echo'])
-        return self._linesep
+        linesep = self._linesep_cache.get(self._cache_key)
+        if linesep is None:
+            linesep = subprocess.check_output([*self._adb_shell_cmd, 'echo'])
+            self._linesep_cache[self._cache_key] = linesep
+        return linesep
 
     @property
     def features(self):
-        if self._features is None:
+        return self._get_feature_info()[0]
+
+    def _get_feature_info(self):
+        info = self._features_cache.get(self._cache_key)
+        if info is None:
+            if self._failed_feature_info is not None:
+                return self._failed_feature_info
             try:
-                self._features = self._simple_call(['features']).splitlines()
+                features = self._simple_call(
+                    ['features']).decode('utf-8').splitlines()
             except subprocess.CalledProcessError:
-                self._features = []
-        return self._features
-
-    def _make_shell_cmd(self, user_cmd):
-        command = self.adb_cmd + ['shell'] + user_cmd
-        if self.SHELL_PROTOCOL_FEATURE not in self.features:
+                # Older adb hosts don't know the command at all. Only remember
+                # that on this instance: the device may just not be ready yet,
+                # and other instances shouldn't inherit that.
+                self._failed_feature_info = ([], True)
+                return self._failed_feature_info
+            info = (features, self.SHELL_PROTOCOL_FEATURE not in features)
+            self._features_cache[self._cache_key] = info
+        return info
+
+    def _clear_device_info(self):
+        self._features_cache.pop(self._cache_key, None)
+        self._linesep_cache.pop(self._cache_key, None)
+        self._failed_feature_info = None
+
+    def _shell_needs_probe(self):
+        """Whether shell output needs the exit code probe (no shell_v2)."""
+        return self._get_feature_info()[1]
+
+    def _make_shell_cmd(self, user_cmd, needs_probe):
+        command = [*self._adb_shell_cmd, *user_cmd]
+        if needs_probe:
             command += self._RETURN_CODE_PROBE
         return command
 
-    def _parse_shell_output(self, out):
-        """Finds the exit code string from shell output.
+    def _find_exit_code(self, out):
+        """Finds the exit code string at the end of shell output.
 
         Args:
-            out: Shell output string.
+            out: Shell output bytes or bytearray.
 
         Returns:
-            An (exit_code, output_string) tuple. The output string is
-            cleaned of any additional stuff we appended to find the
-            exit code.
+            An (exit_code, length) tuple, where length is the number of
+            trailing bytes taken up by the exit code string.
 
         Raises:
             RuntimeError: Could not find the exit code in |out|.
@@ -277,19 +373,59 @@ class AndroidDevice(object):
             # We don't want to search over massive amounts of data when we know
             # the part we want is right at the end.
             search_text = search_text[-self._RETURN_CODE_SEARCH_LENGTH:]
-        partition = search_text.rpartition(self._RETURN_CODE_DELIMITER)
-        if partition[1] == '':
+        partition = search_text.rpartition(
+            self._RETURN_CODE_DELIMITER.encode('ascii'))
+        if not partition[1]:
             raise RuntimeError('Could not find exit status in shell output.')
-        result = int(partition[2])
-        # partition[0] won't contain the full text if search_text was truncated,
-        # pull from the original string instead.
-        out = out[:-len(partition[1]) - len(partition[2])]
-        return result, out
+        return int(partition[2]), len(partition[1]) + len(partition[2])
+
+    def _parse_shell_output(self, out):
+        """Finds the exit code string from shell output.
+
+        Args:
+            out: Shell output bytes.
+
+        Returns:
+            An (exit_code, output_bytes) tuple. The output bytes are
+            cleaned of any additional stuff we appended to find the
+            exit code.
+
+        Raises:
+            RuntimeError: Could not find the exit code in |out|.
+        """
+        result, length = self._find_exit_code(out)
+        return result, out[:len(out) - length]
+
+    def _parse_shell_output_inplace(self, buf):
+        """Like _parse_shell_output(), but trims the bytearray |buf| in place.
+
+        Returns:
+            The exit code.
+        """
+        result, length = self._find_exit_code(buf)
+        del buf[len(buf) - length:]
+        return result
 
     def _simple_call(self, cmd):
-        logging.info(' '.join(self.adb_cmd + cmd))
-        return _subprocess_check_output(
-            self.adb_cmd + cmd, stderr=subprocess.STDOUT)
+        """Runs an adb command and returns its stdout.
+
+        Raises:
+            subprocess.CalledProcessError: adb exited with a non-zero code.
+                The exception's `stderr` holds adb's error output.
+        """
+        _log_command(self.adb_cmd, cmd)
+        # Keep the spawn cheap here and in _simple_check_call: preexec_fn,
+        # user, group or extra_groups force subprocess to fork() and copy our
+        # page tables. cwd, start_new_session and close_fds only rule out
+        # posix_spawn(); CPython 3.10+ still uses vfork() with those.
+        return subprocess.run(
+            self.adb_cmd + cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            check=True).stdout
+
+    def _simple_check_call(self, cmd):
+        """Like _simple_call(), for commands whose output isn't needed."""
+        _log_command(self.adb_cmd, cmd)
+        subprocess.check_call(self.adb_cmd + cmd, stdout=subprocess.DEVNULL)
 
     def shell(self, cmd):
         """Calls `adb shell`
@@ -319,17 +455,267 @@ class AndroidDevice(object):
             An (exit_code, stdout, stderr) tuple. Stderr may be combined
             into stdout if the device doesn't support separate streams.
         """
-        cmd = self._make_shell_cmd(cmd)
-        logging.info(' '.join(cmd))
-        p = _subprocess_Popen(
+        return self._shell_nocheck(cmd, self._shell_needs_probe())
+
+    def _shell_nocheck(self, cmd, needs_probe):
+        """shell_nocheck() with the probe decision already made.
+
+        Callers that depend on how the output will be framed decide once and
+        pass that along, so a features lookup in between can't disagree.
+        """
+        if needs_probe:
+            result = self._persistent_shell_nocheck(cmd)
+            if result is not None:
+                return result
+
+        cmd = self._make_shell_cmd(cmd, needs_probe)
+        _log_command(cmd)
+        p = subprocess.Popen(
             cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         stdout, stderr = p.communicate()
-        if self.SHELL_PROTOCOL_FEATURE in self.features:
+        if not needs_probe:
+            exit_code = p.returncode
+        else:
+            exit_code, stdout = self._parse_shell_output(stdout)
+        return exit_code, stdout, stderr
+
+    async def shell_async(self, cmd):
+        """Like shell(), but as a coroutine.
+
+        Raises:
+            ShellError: the exit code was non-zero.
+        """
+        exit_code, stdout, stderr = await self.shell_nocheck_async(cmd)
+        if exit_code != 0:
+            raise ShellError(cmd, stdout, stderr, exit_code)
+        return stdout, stderr
+
+    async def shell_nocheck_async(self, cmd):
+        """Like shell_nocheck(), but as a coroutine.
+
+        This lets callers run many commands, on one or many devices, from a
+        single event loop, e.g. `await asyncio.gather(*[device.shell_async(c)
+        for c in cmds])`. Throughput is then bound by adbd and the transport
+        rather than by Python. Each call uses its own `adb shell`, never the
+        persistent session. The first call on a device may still block while
+        it queries `adb features`.
+
+        Args:
+            cmd: command to execute as a list of strings.
+
+        Returns:
+            An (exit_code, stdout, stderr) tuple. Stderr may be combined
+            into stdout if the device doesn't support separate streams.
+        """
+        needs_probe = self._shell_needs_probe()
+        cmd = self._make_shell_cmd(cmd, needs_probe)
+        _log_command(cmd)
+        p = await asyncio.create_subprocess_exec(
+            *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = await p.communicate()
+        if not needs_probe:
             exit_code = p.returncode
         else:
             exit_code, stdout = self._parse_shell_output(stdout)
         return exit_code, stdout, stderr
 
+    def batch_shell(self, cmds, stop_on_error=False):
+        """Runs several commands with a single `adb shell` call.
+
+        Args:
+            cmds: list of commands, each a list of strings as for shell().
+            stop_on_error: Whether to skip the remaining commands once one
+                exits with a non-zero code.
+
+        Returns:
+            A list of (exit_code, stdout, stderr) tuples, one per command that
+            was run. Stderr may be combined into stdout if the device doesn't
+            support separate streams.
+
+        Raises:
+            ShellError: the batch ended before every command that should have
+                run did.
+        """
+        if not cmds:
+            return []
+
+        # Each command is followed by its exit code and a separator, which we
+        # split on afterwards. The separator is only written to stderr when
+        # it is a separate stream; otherwise it would end up in stdout.
+        token = uuid.uuid4().hex
+        separators = ['__SEP_{0}_{1}__'.format(token, i)
+                      for i in range(len(cmds))]
+        needs_probe = self._shell_needs_probe()
+        split_stderr = not needs_probe
+        parts = []
+        for cmd, separator in zip(cmds, separators):
+            part = '{0}; __r=$?; '.format(' '.join(cmd))
+            if split_stderr:
+                part += 'echo -n "{0}" >&2; '.format(separator)
+            part += 'echo -n "{0}${{__r}}{1}"'.format(
+                self._RETURN_CODE_DELIMITER, separator)
+            if stop_on_error:
+                part = '{{ {0}; [ ${{__r}} -eq 0 ]; }}'.format(part)
+            parts.append(part)
+        joined = (' && ' if stop_on_error else ' ; ').join(parts)
+
+        exit_code, stdout, stderr = self._shell_nocheck([joined], needs_probe)
+
+        results = []
+        remaining_stdout = stdout
+        remaining_stderr = stderr
+        for separator in separators:
+            separator = separator.encode('ascii')
+            cmd_stdout, found, remaining_stdout = remaining_stdout.partition(
+                separator)
+            if not found:
+                break
+            cmd_exit_code, cmd_stdout = self._parse_shell_output(cmd_stdout)
+            cmd_stderr = b''
+            if split_stderr:
+                cmd_stderr, _, remaining_stderr = remaining_stderr.partition(
+                    separator)
+            results.append((cmd_exit_code, cmd_stdout, cmd_stderr))
+
+        # Commands may only be missing if we stopped after a failing one;
+        # anything else means the batch itself was cut short.
+        if len(results) < len(cmds):
+            if not stop_on_error or not results or results[-1][0] == 0:
+                raise ShellError([joined], stdout, stderr, exit_code)
+        return results
+
+    def _get_persistent_shell(self):
+        p = self._persistent_shell
+        if p is None or p.poll() is not None:
+            self._close_persistent_shell()
+            p = subprocess.Popen(
+                [*self._adb_shell_cmd, 'sh'], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+            # Kill the session when this AndroidDevice is garbage collected,
+            # or at exit at the latest.
+            self._persistent_shell_finalizer = weakref.finalize(
+                self, _kill_process, p)
+            self._persistent_shell = p
+        return p
+
+    def _persistent_shell_nocheck(self, cmd):
+        """Runs a command over the persistent `adb shell` session.
+
+        Only used for devices without shell_v2, which merge stderr into stdout
+        anyway, so the returned stderr is always empty.
+
+        Each command runs under its own `sh -c` (just as a one-off `adb shell`
+        would). Its output is framed by per-call start and end markers, the
+        latter preceded by the exit code probe. Anything before the start
+        marker (output left over from an earlier command, a prompt) is
+        discarded.
+
+        adbd older than Android N allocates a pty even for `adb shell sh`, so
+        our input may be echoed back. The markers are written as two adjacent
+        quoted halves, so the echoed script never contains them verbatim.
+
+        Returns:
+            An (exit_code, stdout, stderr) tuple, or None if the command is
+            too long to send over the session.
+        """
+        start_marker = uuid.uuid4().hex
+        end_marker = uuid.uuid4().hex
+        script = ('echo -n "{0}""{1}"; sh -c {2} </dev/null 2>&1; '
+                  'echo -n "{3}$?{4}""{5}"\n').format(
+                      start_marker[:16], start_marker[16:],
+                      shlex.quote(' '.join(cmd)), self._RETURN_CODE_DELIMITER,
+                      end_marker[:16], end_marker[16:]).encode('utf-8')
+        if len(script) > _PERSISTENT_SHELL_MAX_SCRIPT:
+            return None
+        start_marker = start_marker.encode('ascii')
+        end_marker = end_marker.encode('ascii')
+        _log_command(self._adb_shell_cmd, cmd)
+
+        with self._persistent_shell_lock:
+            try:
+                p = self._get_persistent_shell()
+                p.stdin.write(script)
+                out = bytearray()
+                while True:
+                    chunk = p.stdout.read(_PIPE_READ_SIZE)
+                    if not chunk:
+                        raise RuntimeError(
+                            'adb shell session terminated unexpectedly.')
+                    # Only rescan the part of the buffer the end marker could
+                    # straddle.
+                    search_start = max(0, len(out) - len(end_marker))
+                    out += chunk
+                    end = out.find(end_marker, search_start)
+                    if end != -1:
+                        break
+            except BaseException:
+                # The session's output is no longer in sync with our calls.
+                self._close_persistent_shell()
+                raise
+
+        start = out.rfind(start_marker, 0, end)
+        if start == -1:
+            raise RuntimeError('Could not find start of shell output.')
+        del out[end:]
+        del out[:start + len(start_marker)]
+        exit_code = self._parse_shell_output_inplace(out)
+        return exit_code, bytes(out), b''
+
+    def _close_persistent_shell(self):
+        self._persistent_shell = None
+        if self._persistent_shell_finalizer is not None:
+            self._persistent_shell_finalizer()
+            self._persistent_shell_finalizer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Terminates the persistent `adb shell` session, if any.
+
+        The session is restarted on demand, so the device remains usable.
+        """
+        with self._persistent_shell_lock:
+            self._close_persistent_shell()
+
+    def shell_stream(self, cmd, chunk_size=_PIPE_READ_SIZE):
+        """Calls `adb shell` and yields its stdout as it arrives.
+
+        Unlike shell(), the output is never held in memory all at once, which
+        suits long-running or chatty commands such as `logcat`. Closing the
+        generator early kills the adb process.
+
+        Args:
+            cmd: command to execute as a list of strings.
+            chunk_size: maximum number of bytes to yield at a time.
+
+        Yields:
+            Chunks of stdout. Stderr is not captured.
+
+        Raises:
+            ShellError: adb exited with a non-zero code.
+        """
+        command = [*self._adb_shell_cmd, *cmd]
+        _log_command(command)
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=0)
+        try:
+            while True:
+                chunk = p.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            exit_code = p.wait()
+        finally:
+            if p.returncode is None:
+                p.kill()
+                p.wait()
+            p.stdout.close()
+        if exit_code != 0:
+            raise ShellError(cmd, None, None, exit_code)
+
     def shell_popen(self, cmd, kill_atexit=True, preexec_fn=None,
                     creationflags=0, **kwargs):
         """Calls `adb shell` and returns a handle to the adb process.
@@ -349,7 +735,7 @@ class AndroidDevice(object):
             subprocess.Popen handle to the adb shell instance
         """
 
-        command = self.adb_cmd + ['shell'] + cmd
+        command = [*self._adb_shell_cmd, *cmd]
 
         # Make sure a ctrl-c in the parent script doesn't kill gdbserver.
         if os.name == 'nt':
@@ -364,8 +750,8 @@ class AndroidDevice(object):
                     os.setpgrp()
                 preexec_fn = _wrapper
 
-        p = _subprocess_Popen(command, creationflags=creationflags,
-                              preexec_fn=preexec_fn, **kwargs)
+        p = subprocess.Popen(command, creationflags=creationflags,
+                             preexec_fn=preexec_fn, **kwargs)
 
         if kill_atexit:
             atexit.register(p.kill)
@@ -379,9 +765,25 @@ class AndroidDevice(object):
         cmd.append(filename)
         return self._simple_call(cmd)
 
+    def install_multiple(self, filenames, replace=False):
+        """Installs a single package split across several APKs."""
+        cmd = ['install-multiple']
+        if replace:
+            cmd.append('-r')
+        cmd.extend(filenames)
+        return self._simple_call(cmd)
+
     def push(self, local, remote):
         return self._simple_call(['push', local, remote])
 
+    def push_multi(self, locals_, remote_dir):
+        """Pushes several files into `remote_dir` with one adb invocation.
+
+        Prefer this over calling push() in a loop, which starts a new adb
+        client and sync session for every file.
+        """
+        return self._simple_call(['push', *locals_, remote_dir])
+
     def pull(self, remote, local):
         return self._simple_call(['pull', remote, local])
 
@@ -392,28 +794,55 @@ class AndroidDevice(object):
         return self._simple_call(cmd)
 
     def tcpip(self, port):
-        return self._simple_call(['tcpip', port])
+        self.close()
+        try:
+            return self._simple_call(['tcpip', port])
+        finally:
+            _invalidate_devices_cache(self.adb_cmd[0])
 
     def usb(self):
-        return self._simple_call(['usb'])
+        self.close()
+        try:
+            self._simple_check_call(['usb'])
+        finally:
+            _invalidate_devices_cache(self.adb_cmd[0])
 
     def reboot(self):
-        return self._simple_call(['reboot'])
+        self.close()
+        self._clear_device_info()
+        try:
+            self._simple_check_call(['reboot'])
+        finally:
+            _invalidate_devices_cache(self.adb_cmd[0])
 
     def remount(self):
-        return self._simple_call(['remount'])
+        self._simple_check_call(['remount'])
 
     def root(self):
-        return self._simple_call(['root'])
+        self.close()
+        self._clear_device_info()
+        self._simple_check_call(['root'])
 
     def unroot(self):
+        self.close()
+        self._clear_device_info()
         return self._simple_call(['unroot'])
 
     def connect(self, host):
-        return self._simple_call(['connect', host])
+        self._clear_device_info()
+        try:
+            return self._simple_call(['connect', host])
+        finally:
+            _clear_device_info_for_host(host)
+            _invalidate_devices_cache(self.adb_cmd[0])
 
     def disconnect(self, host):
-        return self._simple_call(['disconnect', host])
+        self._clear_device_info()
+        try:
+            return self._simple_call(['disconnect', host])
+        finally:
+            _clear_device_info_for_host(host)
+            _invalidate_devices_cache(self.adb_cmd[0])
 
     def forward(self, local, remote):
         return self._simple_call(['forward', local, remote])
@@ -446,26 +875,38 @@ class AndroidDevice(object):
         return self._simple_call(['reverse', '--remove', remote])
 
     def wait(self):
-        return self._simple_call(['wait-for-device'])
+        # Invalidate only once the device is back, so a concurrent
+        # get_devices() can't re-cache a listing taken while waiting.
+        try:
+            return self._simple_call(['wait-for-device'])
+        finally:
+            _invalidate_devices_cache(self.adb_cmd[0])
 
     def get_props(self):
         result = {}
-        output, _ = self.shell(['getprop'])
-        output = output.splitlines()
-        pattern = re.compile(r'^\[([^]]+)\]: \[(.*)\]')
-        for line in output:
-            match = pattern.match(line)
+        if self._shell_needs_probe():
+            # Without shell_v2 adb always exits 0, so only shell()'s exit code
+            # probe can tell us whether getprop failed.
+            lines = self.shell(['getprop'])[0].splitlines()
+        else:
+            # Parse as the output arrives rather than holding all of it (and a
+            # list of its lines) in memory at once.
+            lines = _iter_lines(self.shell_stream(['getprop']))
+        for line in lines:
+            match = _GETPROP_RE.match(line)
             if match is None:
-                raise RuntimeError('invalid getprop line: "{}"'.format(line))
-            key = match.group(1)
-            value = match.group(2)
+                raise RuntimeError('invalid getprop line: "{}"'.format(
+                    line.decode('utf-8', 'replace')))
+            key = match.group(1).decode('utf-8')
+            value = match.group(2).decode('utf-8')
             if key in result:
                 raise RuntimeError('duplicate getprop key: "{}"'.format(key))
             result[key] = value
         return result
 
     def get_prop(self, prop_name):
-        output = self.shell(['getprop', prop_name])[0].splitlines()
+        output = self.shell(
+            ['getprop', prop_name])[0].decode('utf-8').splitlines()
         if len(output) != 1:
             raise RuntimeError('Too many lines in getprop output:\n' +
                                '\n'.join(output))
@@ -474,5 +915,33 @@ class AndroidDevice(object):
             return None
         return value
 
+    def get_props_subset(self, prop_names):
+        """Gets several properties with a single `adb shell` call.
+
+        Args:
+            prop_names: list of property names.
+
+        Returns:
+            A dict mapping each name in `prop_names` to its value, or to None
+            if the property is unset.
+
+        Raises:
+            ShellError: a `getprop` invocation failed, or the batch ended
+                before every property was read.
+        """
+        # batch_shell() raises if the batch is cut short, and otherwise only
+        # stops early after a failed getprop, which raises below, so every
+        # name gets a value.
+        results = self.batch_shell(
+            [['getprop', shlex.quote(name)] for name in prop_names],
+            stop_on_error=True)
+        props = {}
+        for name, (exit_code, stdout, stderr) in zip(prop_names, results):
+            if exit_code != 0:
+                raise ShellError(['getprop', name], stdout, stderr, exit_code)
+            value = stdout.decode('utf-8').rstrip('\r\n')
+            props[name] = value if value.strip() else None
+        return props
+
     def set_prop(self, prop_name, value):
         self.shell(['setprop', prop_name, value])